@@ -11,6 +11,7 @@ class Settings:
     bot_token: str
     openai_api_key: str
     openai_model: str = "gpt-4.1"
+    openai_stream: bool = False
     db_path: str = "offers.db"
     log_level: str = "INFO"
 
@@ -25,6 +26,7 @@ class SettingsFactory:
         bot_token = os.getenv("BOT_TOKEN")
         openai_api_key = os.getenv("OPENAI_API_KEY")
         openai_model = os.getenv("OPENAI_MODEL", Settings.openai_model)
+        openai_stream = os.getenv("OPENAI_STREAM", "").lower() in ("1", "true", "yes")
         db_path = os.getenv("DB_PATH", Settings.db_path)
         log_level = os.getenv("LOG_LEVEL", Settings.log_level)
 
@@ -36,6 +38,7 @@ class SettingsFactory:
             bot_token=bot_token,
             openai_api_key=openai_api_key,
             openai_model=openai_model,
+            openai_stream=openai_stream,
             db_path=db_path,
             log_level=log_level,
         )
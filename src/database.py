@@ -1,115 +1,383 @@
+import asyncio
 import logging
-from datetime import datetime
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
 from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
 
 import aiosqlite
 
 logger = logging.getLogger(__name__)
 
+_BY_ID_CACHE_MAX = 256
+
+# Поднимать при каждом изменении схемы: init() пропускает блок миграций,
+# когда PRAGMA user_version уже соответствует.
+_SCHEMA_VERSION = 4
+
+# Вычисляемые колонки с готовыми значениями для отображения: подстановка
+# «—»/«курс ?» делается один раз в SQLite, а не на каждый рендер строки.
+_DISPLAY_COLUMNS = {
+    "kind_display": "COALESCE(kind, '—')",
+    "country_display": "COALESCE(country, '—')",
+    "method_display": "COALESCE(method, '—')",
+    "fee_display": "COALESCE(fee, fee_percent || '%', '—')",
+    "rate_display": "COALESCE(rate, 'курс ?')",
+}
+
+# Биты присутствия фильтров search_offers — ключ кеша готовых SQL-строк.
+_MASK_COUNTRY = 1
+_MASK_METHOD = 2
+_MASK_STATUS = 4
+_MASK_KIND = 8
+_MASK_MIN_FEE = 16
+_MASK_MAX_FEE = 32
+
+_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE offers_fts USING fts5(
+    country, method, conditions, raw_text,
+    content='offers', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER offers_fts_ai AFTER INSERT ON offers BEGIN
+    INSERT INTO offers_fts (rowid, country, method, conditions, raw_text)
+    VALUES (new.id, new.country, new.method, new.conditions, new.raw_text);
+END;
+CREATE TRIGGER offers_fts_ad AFTER DELETE ON offers BEGIN
+    INSERT INTO offers_fts (offers_fts, rowid, country, method, conditions, raw_text)
+    VALUES ('delete', old.id, old.country, old.method, old.conditions, old.raw_text);
+END;
+CREATE TRIGGER offers_fts_au AFTER UPDATE ON offers BEGIN
+    INSERT INTO offers_fts (offers_fts, rowid, country, method, conditions, raw_text)
+    VALUES ('delete', old.id, old.country, old.method, old.conditions, old.raw_text);
+    INSERT INTO offers_fts (rowid, country, method, conditions, raw_text)
+    VALUES (new.id, new.country, new.method, new.conditions, new.raw_text);
+END;
+"""
+
+
+_INSERT_OFFER_SQL = """
+INSERT INTO offers (
+    raw_text, country, method, fee, rate, limits,
+    conditions, status, created_at, updated_at,
+    kind, fee_percent
+)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+_now_iso_cache: Optional[Tuple[int, str]] = None
+
+
+def _now_iso() -> str:
+    """ISO-метка времени, мемоизированная с точностью до секунды.
+
+    При массовых вставках экономит аллокацию datetime и форматирование
+    на каждую строку — остаётся int(time.time()) плюс сравнение.
+    """
+    global _now_iso_cache
+    now = int(time.time())
+    cached = _now_iso_cache
+    if cached is not None and cached[0] == now:
+        return cached[1]
+    # Наивный UTC, как и раньше, но без устаревшего utcfromtimestamp.
+    formatted = datetime.fromtimestamp(now, tz=timezone.utc).replace(tzinfo=None).isoformat()
+    _now_iso_cache = (now, formatted)
+    return formatted
+
+
+def _safe_float(value: Any) -> Optional[float]:
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _offer_row(parsed: Dict[str, Any], raw_text: str, now: str) -> Tuple[Any, ...]:
+    return (
+        raw_text,
+        parsed.get("country"),
+        parsed.get("method"),
+        parsed.get("fee"),
+        parsed.get("rate"),
+        parsed.get("limits"),
+        parsed.get("conditions"),
+        "new",
+        now,
+        now,
+        parsed.get("kind"),
+        _safe_float(parsed.get("fee_percent")),
+    )
+
+
+_OFFER_ROW_FMT = "ID *{oid}* — [{kind}] {country} / {method} / {fee} / {rate} — _{status}_"
+
+
+def format_offer_row(oid: Any, country: Any, method: Any, fee: Any, rate: Any, status: Any, kind: Any) -> str:
+    # Значения приходят из *_display-колонок уже с подставленными «—».
+    return _OFFER_ROW_FMT.format(
+        oid=oid,
+        kind=kind,
+        country=country,
+        method=method,
+        fee=fee,
+        rate=rate,
+        status=status,
+    )
+
+
+def _fts_prefix_match(column: str, value: str) -> Optional[str]:
+    """Builds a quoted prefix MATCH expression for one column, e.g. `country:"india"*`.
+
+    User input is quoted token-by-token so FTS5 operators (`-`, `"`, `NOT` …)
+    are treated as literal text.
+    """
+    tokens = [token.replace('"', "") for token in value.split()]
+    tokens = [token for token in tokens if token]
+    if not tokens:
+        return None
+    return " ".join(f'{column}:"{token}"*' for token in tokens)
+
 
 class OfferRepository:
     def __init__(self, db_path: str) -> None:
         self.db_path = db_path
+        self._fts_enabled = False
+        self._db: Optional[aiosqlite.Connection] = None
+        # WAL допускает параллельных читателей, но писатель должен быть один.
+        self._write_lock = asyncio.Lock()
+        # Кеши читающих запросов: результаты неизменны между записями.
+        self._recent_cache: Optional[Tuple[int, List[Sequence[Any]]]] = None
+        self._by_id_cache: "OrderedDict[int, Tuple[Any, ...]]" = OrderedDict()
+        self._search_sql_cache: Dict[Tuple[bool, int], str] = {}
 
     async def init(self) -> None:
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
-                """
-                CREATE TABLE IF NOT EXISTS offers (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    raw_text TEXT NOT NULL,
-                    country TEXT,
-                    method TEXT,
-                    fee TEXT,
-                    rate TEXT,
-                    limits TEXT,
-                    conditions TEXT,
-                    status TEXT NOT NULL DEFAULT 'new',
-                    created_at TEXT NOT NULL,
-                    updated_at TEXT NOT NULL
-                );
-                """
-            )
+        db = self._db = await aiosqlite.connect(self.db_path)
+        await db.execute("PRAGMA journal_mode=WAL")
+        await db.execute("PRAGMA synchronous=NORMAL")
+        await db.execute("PRAGMA temp_store=MEMORY")
+        await db.execute("PRAGMA mmap_size=268435456")
+
+        cursor = await db.execute("PRAGMA user_version")
+        (version,) = await cursor.fetchone()
+        if version < _SCHEMA_VERSION:
+            await self._migrate(db)
+            await db.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
             await db.commit()
+        else:
+            self._fts_enabled = await self._fts_exists(db)
 
-            cursor = await db.execute("PRAGMA table_info(offers);")
-            columns = [row[1] for row in await cursor.fetchall()]
+        logger.info(
+            "Database initialised at %s (schema v%s, FTS5: %s)",
+            self.db_path,
+            _SCHEMA_VERSION,
+            self._fts_enabled,
+        )
 
-            if "kind" not in columns:
-                await db.execute("ALTER TABLE offers ADD COLUMN kind TEXT;")
-            if "fee_percent" not in columns:
-                await db.execute("ALTER TABLE offers ADD COLUMN fee_percent REAL;")
+    async def _migrate(self, db: aiosqlite.Connection) -> None:
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS offers (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                raw_text TEXT NOT NULL,
+                country TEXT,
+                method TEXT,
+                fee TEXT,
+                rate TEXT,
+                limits TEXT,
+                conditions TEXT,
+                status TEXT NOT NULL DEFAULT 'new',
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL
+            );
+            """
+        )
+        await db.commit()
 
-            await db.commit()
+        cursor = await db.execute("PRAGMA table_info(offers);")
+        columns = [row[1] for row in await cursor.fetchall()]
 
-        logger.info("Database initialised at %s", self.db_path)
+        if "kind" not in columns:
+            await db.execute("ALTER TABLE offers ADD COLUMN kind TEXT;")
+        if "fee_percent" not in columns:
+            await db.execute("ALTER TABLE offers ADD COLUMN fee_percent REAL;")
+        for name, expression in _DISPLAY_COLUMNS.items():
+            if name not in columns:
+                await db.execute(
+                    f"ALTER TABLE offers ADD COLUMN {name} TEXT "
+                    f"GENERATED ALWAYS AS ({expression}) VIRTUAL;"
+                )
+
+        # Составные индексы закрывают нетекстовые предикаты search_offers
+        # вместе с ORDER BY id DESC; текст идёт через FTS5.
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_offers_fee_id ON offers(fee_percent, id DESC);"
+        )
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_offers_kind_country_id ON offers(kind, country, id DESC);"
+        )
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_offers_status_id ON offers(status, id DESC);"
+        )
+        # Индексы по выражению для LIKE-фолбэка без FTS5: префиксный
+        # LOWER(col) LIKE 'x%' становится range-scan'ом по индексу.
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_offers_country_lc ON offers(LOWER(country));"
+        )
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_offers_method_lc ON offers(LOWER(method));"
+        )
+        await db.execute("ANALYZE;")
+
+        await db.commit()
+
+        await self._init_fts(db)
+
+    async def close(self) -> None:
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    @staticmethod
+    async def _fts_exists(db: aiosqlite.Connection) -> bool:
+        cursor = await db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'offers_fts'"
+        )
+        return await cursor.fetchone() is not None
+
+    async def _init_fts(self, db: aiosqlite.Connection) -> None:
+        try:
+            if not await self._fts_exists(db):
+                await db.executescript(_FTS_SCHEMA)
+                await db.execute("INSERT INTO offers_fts (offers_fts) VALUES ('rebuild')")
+                await db.commit()
+            self._fts_enabled = True
+        except aiosqlite.OperationalError as exc:
+            logger.warning("FTS5 недоступен, поиск работает через LIKE: %s", exc)
+            self._fts_enabled = False
 
     async def save_offer(self, parsed: Dict[str, Any], raw_text: str) -> int:
-        now = datetime.utcnow().isoformat()
+        ids = await self.save_offers_bulk([(parsed, raw_text)])
+        return ids[0]
 
-        def safe_float(value: Any) -> Optional[float]:
-            try:
-                return float(value) if value is not None else None
-            except (TypeError, ValueError):
-                return None
+    async def save_offers_bulk(self, items: List[Tuple[Dict[str, Any], str]]) -> List[int]:
+        """Сохраняет пачку офферов одной транзакцией, возвращает их ID."""
+        now = _now_iso()
+        rows = [_offer_row(parsed, raw_text, now) for parsed, raw_text in items]
 
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute(
-                """
-                INSERT INTO offers (
-                    raw_text, country, method, fee, rate, limits,
-                    conditions, status, created_at, updated_at,
-                    kind, fee_percent
-                )
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """,
-                (
-                    raw_text,
-                    parsed.get("country"),
-                    parsed.get("method"),
-                    parsed.get("fee"),
-                    parsed.get("rate"),
-                    parsed.get("limits"),
-                    parsed.get("conditions"),
-                    "new",
-                    now,
-                    now,
-                    parsed.get("kind"),
-                    safe_float(parsed.get("fee_percent")),
-                ),
-            )
-            await db.commit()
-            return cursor.lastrowid
+        async with self._write_lock:
+            await self._db.executemany(_INSERT_OFFER_SQL, rows)
+            cursor = await self._db.execute("SELECT last_insert_rowid()")
+            (last_id,) = await cursor.fetchone()
+            await self._db.commit()
+            # По-id кеш не трогаем — новые ID там появиться не могли.
+            self._recent_cache = None
+            # Писатель один (write_lock), поэтому ID идут подряд.
+            return list(range(last_id - len(rows) + 1, last_id + 1))
 
     async def list_last_offers(self, limit: int = 10) -> List[Sequence[Any]]:
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute(
+        if self._recent_cache is not None and self._recent_cache[0] >= limit:
+            return self._recent_cache[1][:limit]
+
+        fetch_limit = max(limit, 64)
+        cursor = await self._db.execute(
+            """
+            SELECT id, country_display, method_display, fee_display, rate_display,
+                   status, created_at, kind_display, fee_percent
+            FROM offers
+            ORDER BY id DESC
+            LIMIT ?
+            """,
+            (fetch_limit,),
+        )
+        rows = await cursor.fetchall()
+        self._recent_cache = (fetch_limit, rows)
+        return rows[:limit]
+
+    async def list_last_offers_rendered(self, limit: int = 10) -> List[str]:
+        """Последние офферы уже в виде строк для ответа в чат."""
+        rows = await self.list_last_offers(limit)
+        # row: (id, country, method, fee, rate, status, created_at, kind, fee_percent)
+        return [format_offer_row(r[0], r[1], r[2], r[3], r[4], r[5], r[7]) for r in rows]
+
+    async def get_offer_by_id(self, offer_id: int) -> Optional[Tuple[Any, ...]]:
+        cached = self._by_id_cache.get(offer_id)
+        if cached is not None:
+            self._by_id_cache.move_to_end(offer_id)
+            return cached
+
+        cursor = await self._db.execute(
+            """
+            SELECT id, raw_text, country_display, method_display, fee_display, rate_display,
+                   limits, conditions, status, created_at, updated_at,
+                   kind_display, fee_percent
+            FROM offers
+            WHERE id = ?
+            """,
+            (offer_id,),
+        )
+        row = await cursor.fetchone()
+        if row is not None:
+            self._by_id_cache[offer_id] = row
+            if len(self._by_id_cache) > _BY_ID_CACHE_MAX:
+                self._by_id_cache.popitem(last=False)
+        return row
+
+    def _search_sql(self, use_fts: bool, mask: int) -> str:
+        """Возвращает специализированный SQL для комбинации фильтров.
+
+        Строки собираются по одному разу на маску и дальше переиспользуются,
+        так что кеш подготовленных выражений SQLite стабильно попадает.
+        """
+        key = (use_fts, mask)
+        query = self._search_sql_cache.get(key)
+        if query is not None:
+            return query
+
+        conditions: List[str] = []
+        if not use_fts:
+            if mask & _MASK_COUNTRY:
+                conditions.append("LOWER(country) LIKE ?")
+            if mask & _MASK_METHOD:
+                conditions.append("LOWER(method) LIKE ?")
+        if mask & _MASK_STATUS:
+            conditions.append("status = ?")
+        if mask & _MASK_KIND:
+            conditions.append("kind = ?")
+        if mask & _MASK_MIN_FEE:
+            conditions.append("fee_percent >= ?")
+        if mask & _MASK_MAX_FEE:
+            conditions.append("fee_percent <= ?")
+
+        if use_fts:
+            # Текстовые предикаты идут через инвертированный индекс FTS5,
+            # числовые/статусные остаются на базовой таблице.
+            where_clause = " AND ".join(["offers_fts MATCH ?"] + conditions)
+            query = f"""
+                SELECT o.id, o.country_display, o.method_display, o.fee_display,
+                       o.rate_display, o.status, o.kind_display, o.fee_percent
+                FROM offers_fts f
+                JOIN offers o ON o.id = f.rowid
+                WHERE {where_clause}
+                ORDER BY o.id DESC
+                LIMIT ?
                 """
-                SELECT id, country, method, fee, rate, status, created_at, kind, fee_percent
+        else:
+            where_clause = " AND ".join(conditions) if conditions else "1=1"
+            query = f"""
+                SELECT id, country_display, method_display, fee_display,
+                       rate_display, status, kind_display, fee_percent
                 FROM offers
+                WHERE {where_clause}
                 ORDER BY id DESC
                 LIMIT ?
-                """,
-                (limit,),
-            )
-            return await cursor.fetchall()
-
-    async def get_offer_by_id(self, offer_id: int) -> Optional[Tuple[Any, ...]]:
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute(
                 """
-                SELECT id, raw_text, country, method, fee, rate,
-                       limits, conditions, status, created_at, updated_at,
-                       kind, fee_percent
-                FROM offers
-                WHERE id = ?
-                """,
-                (offer_id,),
-            )
-            return await cursor.fetchone()
+
+        self._search_sql_cache[key] = query
+        return query
 
     async def search_offers(self, filters: Dict[str, Any], limit: int = 20) -> List[Sequence[Any]]:
-        conditions: List[str] = []
+        mask = 0
         params: List[Any] = []
 
         country = filters.get("country")
@@ -119,37 +387,50 @@ class OfferRepository:
         min_fee = filters.get("min_fee_percent")
         max_fee = filters.get("max_fee_percent")
 
-        if country:
-            conditions.append("LOWER(country) LIKE ?")
-            params.append(f"%{country.lower()}%")
-        if method:
-            conditions.append("LOWER(method) LIKE ?")
-            params.append(f"%{method.lower()}%")
+        match_parts: List[str] = []
+        if self._fts_enabled:
+            if country:
+                part = _fts_prefix_match("country", country)
+                if part:
+                    match_parts.append(part)
+            if method:
+                part = _fts_prefix_match("method", method)
+                if part:
+                    match_parts.append(part)
+
+        use_fts = bool(match_parts)
+        if use_fts:
+            params.append(" AND ".join(match_parts))
+        elif not self._fts_enabled:
+            # Префикс вместо '%x%': такой LIKE использует индексы по
+            # LOWER(...), а сабстринг-поиск закрывает основной FTS5-путь.
+            if country:
+                mask |= _MASK_COUNTRY
+                params.append(f"{country.lower()}%")
+            if method:
+                mask |= _MASK_METHOD
+                params.append(f"{method.lower()}%")
+
         if status:
-            conditions.append("status = ?")
+            mask |= _MASK_STATUS
             params.append(status)
         if kind:
-            conditions.append("kind = ?")
+            mask |= _MASK_KIND
             params.append(kind)
         if min_fee is not None:
-            conditions.append("fee_percent >= ?")
+            mask |= _MASK_MIN_FEE
             params.append(float(min_fee))
         if max_fee is not None:
-            conditions.append("fee_percent <= ?")
+            mask |= _MASK_MAX_FEE
             params.append(float(max_fee))
 
-        where_clause = " AND ".join(conditions) if conditions else "1=1"
         params.append(limit)
 
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute(
-                f"""
-                SELECT id, country, method, fee, rate, status, kind, fee_percent
-                FROM offers
-                WHERE {where_clause}
-                ORDER BY id DESC
-                LIMIT ?
-                """,
-                params,
-            )
-            return await cursor.fetchall()
+        cursor = await self._db.execute(self._search_sql(use_fts, mask), params)
+        return await cursor.fetchall()
+
+    async def search_offers_rendered(self, filters: Dict[str, Any], limit: int = 20) -> List[str]:
+        """Результаты поиска уже в виде строк для ответа в чат."""
+        rows = await self.search_offers(filters, limit)
+        # row: (id, country, method, fee, rate, status, kind, fee_percent)
+        return [format_offer_row(*row[:7]) for row in rows]
@@ -1,9 +1,11 @@
+import asyncio
 import logging
+
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters
 
 from .config import SettingsFactory, configure_logging
 from .database import OfferRepository
-from .openai_service import OfferInterpreter
+from .openai_service import OfferInterpreter, SemanticCache
 from .service import BotService
 
 
@@ -15,16 +17,31 @@ def build_application():
     )
 
     offers_repo = OfferRepository(settings.db_path)
-    interpreter = OfferInterpreter(settings.openai_api_key, settings.openai_model)
+    interpret_cache = SemanticCache(settings.db_path)
+    interpreter = OfferInterpreter(
+        settings.openai_api_key,
+        settings.openai_model,
+        cache=interpret_cache,
+        stream=settings.openai_stream,
+    )
     bot_service = BotService(offers_repo, interpreter)
 
     async def post_init(application):
         await offers_repo.init()
+        await interpret_cache.init()
+        await bot_service.load_commit_hash()
+        # Прогрев TLS-сессии к OpenAI — в фоне, чтобы не задерживать старт.
+        asyncio.create_task(interpreter.warmup())
+
+    async def post_shutdown(application):
+        await offers_repo.close()
+        await interpret_cache.close()
 
     application = (
         ApplicationBuilder()
         .token(settings.bot_token)
         .post_init(post_init)
+        .post_shutdown(post_shutdown)
         .build()
     )
 
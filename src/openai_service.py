@@ -1,57 +1,227 @@
-import json
+import asyncio
 import logging
-from typing import Any, Dict
+import time
+from array import array
+from typing import Any, Dict, List, Optional
 
-from openai import OpenAI
+import aiosqlite
+import orjson
+from openai import AsyncOpenAI
 
 logger = logging.getLogger(__name__)
 
+_EMBEDDING_MODEL = "text-embedding-3-small"
+
+# Статичный префикс: собирается один раз и не меняется между запросами,
+# что также позволяет OpenAI переиспользовать его серверный KV-кеш.
+_SYSTEM_PROMPT = (
+    "Ты ассистент CRM агрегатора платежей.\n"
+    "Пользователь может:\n"
+    "1) прислать ОФФЕР (описание платёжного канала или мерчанта);\n"
+    "2) задать ПОИСКОВЫЙ ЗАПРОС по базе офферов простыми словами.\n\n"
+    "Твоя задача — определить режим и вернуть ТОЛЬКО валидный JSON.\n"
+    "Никакого текста кроме JSON.\n\n"
+    "Правила классификации:\n"
+    "- 'search' если пользователь просит показать, найти, выдать, дай, нужны и т.п.\n"
+    "- 'offer' если перечислены условия конкретного канала/мерчанта (комиссия, курс, лимиты и т.д.).\n"
+    "- Если сомневаешься — выбери 'offer' и сохрани весь текст в 'conditions'.\n\n"
+    "Парсинг оффера:\n"
+    "- Извлеки country, method, fee, rate, limits, kind (channel/merchant), fee_percent.\n"
+    "- Всё, что не удалось разложить по полям, обязательно помести в 'conditions' (комментарии).\n"
+    "- 'short_summary' — одно предложение о сути оффера.\n\n"
+    "Парсинг поиска:\n"
+    "- Понимай проценты: 'дешевле 11%' => max_fee_percent = 11.0.\n"
+    "- Учитывай любые указания по стране/методу/статусу/kind.\n"
+    "- Если явного запроса нет, но текст похож на оффер — верни 'offer'.\n"
+)
+
+
+class SemanticCache:
+    """Embedding-keyed cache for interpret() results.
+
+    Near-duplicate queries («дай офферы по индии» / «покажи офферы индия»)
+    get the cached JSON back without a chat-completion round-trip.
+    """
+
+    def __init__(self, db_path: str, similarity_threshold: float = 0.93, ttl_seconds: int = 7 * 24 * 3600) -> None:
+        self.db_path = db_path
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self._db: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+
+    async def init(self) -> None:
+        self._db = await aiosqlite.connect(self.db_path)
+        await self._db.execute("PRAGMA journal_mode=WAL")
+        await self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS interpret_cache (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                embedding BLOB NOT NULL,
+                response_json TEXT NOT NULL,
+                created_at INTEGER NOT NULL
+            );
+            """
+        )
+        await self._db.execute(
+            "DELETE FROM interpret_cache WHERE created_at < ?",
+            (int(time.time()) - self.ttl_seconds,),
+        )
+        await self._db.commit()
+
+    async def close(self) -> None:
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    async def lookup(self, embedding: List[float]) -> Optional[Dict[str, Any]]:
+        best_score = 0.0
+        best_json: Optional[str] = None
+        cursor = await self._db.execute(
+            "SELECT embedding, response_json FROM interpret_cache WHERE created_at >= ?",
+            (int(time.time()) - self.ttl_seconds,),
+        )
+        async for blob, response_json in cursor:
+            cached = array("f")
+            cached.frombytes(blob)
+            if len(cached) != len(embedding):
+                continue
+            # Эмбеддинги OpenAI нормированы, поэтому скалярное
+            # произведение равно косинусной близости.
+            score = sum(a * b for a, b in zip(embedding, cached))
+            if score > best_score:
+                best_score = score
+                best_json = response_json
+
+        if best_json is not None and best_score >= self.similarity_threshold:
+            logger.info("Semantic cache hit (similarity=%.3f)", best_score)
+            return orjson.loads(best_json)
+        return None
+
+    async def store(self, embedding: List[float], parsed: Dict[str, Any]) -> None:
+        async with self._write_lock:
+            await self._db.execute(
+                "INSERT INTO interpret_cache (embedding, response_json, created_at) VALUES (?, ?, ?)",
+                (array("f", embedding).tobytes(), orjson.dumps(parsed), int(time.time())),
+            )
+            await self._db.commit()
+
 
 class OfferInterpreter:
-    def __init__(self, api_key: str, model: str) -> None:
-        self.client = OpenAI(api_key=api_key)
+    def __init__(
+        self,
+        api_key: str,
+        model: str,
+        cache: Optional[SemanticCache] = None,
+        stream: bool = False,
+    ) -> None:
+        self.client = AsyncOpenAI(api_key=api_key)
         self.model = model
+        self.cache = cache
+        self.stream = stream
+        self._system_message = {"role": "system", "content": _SYSTEM_PROMPT}
 
-    async def interpret(self, text: str) -> Dict[str, Any]:
-        system_prompt = (
-            "Ты ассистент CRM агрегатора платежей.\n"
-            "Пользователь может:\n"
-            "1) прислать ОФФЕР (описание платёжного канала или мерчанта);\n"
-            "2) задать ПОИСКОВЫЙ ЗАПРОС по базе офферов простыми словами.\n\n"
-            "Твоя задача — определить режим и вернуть ТОЛЬКО валидный JSON.\n"
-            "Никакого текста кроме JSON.\n\n"
-            "Правила классификации:\n"
-            "- 'search' если пользователь просит показать, найти, выдать, дай, нужны и т.п.\n"
-            "- 'offer' если перечислены условия конкретного канала/мерчанта (комиссия, курс, лимиты и т.д.).\n"
-            "- Если сомневаешься — выбери 'offer' и сохрани весь текст в 'conditions'.\n\n"
-            "Парсинг оффера:\n"
-            "- Извлеки country, method, fee, rate, limits, kind (channel/merchant), fee_percent.\n"
-            "- Всё, что не удалось разложить по полям, обязательно помести в 'conditions' (комментарии).\n"
-            "- 'short_summary' — одно предложение о сути оффера.\n\n"
-            "Парсинг поиска:\n"
-            "- Понимай проценты: 'дешевле 11%' => max_fee_percent = 11.0.\n"
-            "- Учитывай любые указания по стране/методу/статусу/kind.\n"
-            "- Если явного запроса нет, но текст похож на оффер — верни 'offer'.\n"
-        )
+    async def warmup(self) -> None:
+        """Открывает HTTP-соединение к OpenAI до первого реального запроса.
+
+        AsyncOpenAI держит один httpx-клиент с пулом keep-alive соединений;
+        лёгкий GET устанавливает TLS-сессию заранее, чтобы первый
+        interpret() не платил за рукопожатие.
+        """
+        try:
+            await self.client.models.retrieve(self.model)
+        except Exception as exc:  # noqa: BLE001
+            logger.warning("Не удалось прогреть соединение с OpenAI: %s", exc)
 
-        response = self.client.chat.completions.create(
+    async def _embed(self, text: str) -> List[float]:
+        response = await self.client.embeddings.create(model=_EMBEDDING_MODEL, input=text)
+        return response.data[0].embedding
+
+    async def _complete_streaming(self, text: str) -> str:
+        """Собирает ответ из stream-чанков и выходит, как только JSON-объект закрылся.
+
+        Скобки считаются с учётом строк и экранирования, поэтому `{`/`}`
+        внутри значений не ломают счётчик. Хвост после закрывающей скобки
+        (пробелы, пустые чанки) не дожидаемся.
+        """
+        stream = await self.client.chat.completions.create(
             model=self.model,
             response_format={"type": "json_object"},
             messages=[
-                {"role": "system", "content": system_prompt},
+                self._system_message,
                 {"role": "user", "content": text},
             ],
+            stream=True,
         )
 
-        content = response.choices[0].message.content
+        chunks: List[str] = []
+        depth = 0
+        started = False
+        in_string = False
+        escaped = False
+        async for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if not delta:
+                continue
+            chunks.append(delta)
+            for char in delta:
+                if escaped:
+                    escaped = False
+                elif in_string:
+                    if char == "\\":
+                        escaped = True
+                    elif char == '"':
+                        in_string = False
+                elif char == '"':
+                    in_string = True
+                elif char == "{":
+                    depth += 1
+                    started = True
+                elif char == "}":
+                    depth -= 1
+                    if started and depth == 0:
+                        await stream.close()
+                        return "".join(chunks)
+        return "".join(chunks)
+
+    async def interpret(self, text: str) -> Dict[str, Any]:
+        embedding: Optional[List[float]] = None
+        if self.cache is not None:
+            try:
+                embedding = await self._embed(text)
+                cached = await self.cache.lookup(embedding)
+                if cached is not None:
+                    return cached
+            except Exception as exc:  # noqa: BLE001
+                logger.warning("Семантический кеш недоступен: %s", exc)
+                embedding = None
+
+        if self.stream:
+            content = await self._complete_streaming(text)
+        else:
+            response = await self.client.chat.completions.create(
+                model=self.model,
+                response_format={"type": "json_object"},
+                messages=[
+                    self._system_message,
+                    {"role": "user", "content": text},
+                ],
+            )
+            content = response.choices[0].message.content
         logger.info("OpenAI response: %s", content)
 
         try:
-            parsed = json.loads(content)
+            parsed = orjson.loads(content)
             if not isinstance(parsed, dict):
                 raise ValueError("JSON is not an object")
-            return parsed
         except Exception as exc:  # noqa: BLE001
             raise RuntimeError(
                 f"Не удалось распарсить JSON OpenAI: {exc}\nОтвет: {content}"
             ) from exc
+
+        if self.cache is not None and embedding is not None:
+            try:
+                await self.cache.store(embedding, parsed)
+            except Exception as exc:  # noqa: BLE001
+                logger.warning("Не удалось записать в семантический кеш: %s", exc)
+        return parsed
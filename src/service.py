@@ -1,7 +1,13 @@
+import asyncio
+import hashlib
 import logging
-import subprocess
-from datetime import datetime
-from typing import Any, Dict, List
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+import orjson
 
 from telegram import Update
 from telegram.ext import ContextTypes
@@ -11,10 +17,90 @@ from .openai_service import OfferInterpreter
 
 logger = logging.getLogger(__name__)
 
+_START_TEXT = (
+    "👋 Привет! Я CRM-бот агрегатора.\n\n"
+    "Я умею:\n"
+    "1) Принимать офферы (каналы/мерчи) и сохранять их в базу.\n"
+    "2) Искать по базе простыми фразами.\n\n"
+    "Примеры:\n"
+    "- RU SBP вход 1.8% курс 98 лимиты 10k–300k\n"
+    "- дай все офферы по индии\n"
+    "- дай офферы по сбп рф дешевле 11%\n\n"
+    "Последние офферы: /offers\n"
+    "Оффер по ID: /offer 10"
+)
+
+_UNKNOWN_MODE_TEXT = (
+    "Я не понял, это оффер или поиск 🤔\n"
+    "Попробуй переформулировать или начни с чего-то вроде:\n"
+    "— 'дай офферы по ...'\n"
+    "— или просто пришли оффер."
+)
+
+_VERSION_TEMPLATE = "ℹ️ *Версия бота*\nCommit: `{commit}`\nЗапущен: {started}"
+
+_DASH = "—"
+
+_LAST_OFFERS_HEADER = "📋 *Последние офферы:*\n\n"
+_SEARCH_HEADER = "📋 *Результаты поиска:*\n\n"
+
+_INTERPRET_CACHE_MAX = 2048
+
+_SEARCH_CACHE_MAX = 512
+_SEARCH_CACHE_TTL = 60.0
+
+_OFFER_CACHE_MAX = 1024
+
+
+def _log_send_failure(task: "asyncio.Task[Any]") -> None:
+    if task.cancelled():
+        return
+    exc = task.exception()
+    if exc is not None:
+        logger.error("Не удалось отправить ответ: %s", exc)
+
+
+def _send_in_background(coro: Any) -> None:
+    """Отправляет сообщение фоновой задачей, не держа хендлер до ACK Telegram."""
+    task = asyncio.create_task(coro)
+    task.add_done_callback(_log_send_failure)
 
-def get_last_commit_hash() -> str:
+
+def _interpret_cache_key(user_text: str) -> bytes:
+    return hashlib.blake2b(user_text.strip().lower().encode(), digest_size=16).digest()
+
+
+def _search_cache_key(filters: Dict[str, Any]) -> bytes:
+    fingerprint = orjson.dumps(filters, option=orjson.OPT_SORT_KEYS)
+    return hashlib.blake2b(fingerprint, digest_size=16).digest()
+
+
+def _static_commit_hash() -> Optional[str]:
+    # Константа, сгенерированная при сборке
+    # (`echo "COMMIT = '$(git rev-parse HEAD)'" > src/_commit.py`),
+    # либо переменная окружения — оба варианта без subprocess.
     try:
-        return subprocess.check_output(["git", "rev-parse", "HEAD"]).decode().strip()
+        from ._commit import COMMIT
+        return COMMIT
+    except ImportError:
+        pass
+    return os.environ.get("GIT_COMMIT") or None
+
+
+async def _git_commit_hash() -> str:
+    """Фолбэк через git, не блокирующий event loop."""
+    try:
+        process = await asyncio.create_subprocess_exec(
+            "git",
+            "rev-parse",
+            "HEAD",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        stdout, _ = await process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError(f"git rev-parse завершился с кодом {process.returncode}")
+        return stdout.decode().strip()
     except Exception as exc:  # noqa: BLE001
         logger.error("Не удалось получить хеш коммита: %s", exc)
         return "unknown"
@@ -24,78 +110,106 @@ class BotService:
     def __init__(self, offers: OfferRepository, interpreter: OfferInterpreter) -> None:
         self.offers = offers
         self.interpreter = interpreter
-        self.started_at = datetime.utcnow().isoformat() + "Z"
-        self.commit_hash = get_last_commit_hash()
+        self.started_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        self._commit_hash: Optional[str] = _static_commit_hash()
+        self._commit_lock = asyncio.Lock()
+        # Текст /version неизменен после старта — рендерится один раз.
+        self._version_text: Optional[str] = None
+        # LRU распознанных запросов: одинаковые фразы не гоняют модель повторно.
+        self._interpret_cache: "OrderedDict[bytes, Dict[str, Any]]" = OrderedDict()
+        # Результаты поиска по отпечатку фильтров; сбрасывается при записи.
+        self._search_cache: "OrderedDict[bytes, Tuple[float, List[str]]]" = OrderedDict()
+        # Готовый текст /offers; живёт до следующей записи. Лок защищает
+        # от одновременного пересчёта при наплыве команд.
+        self._last_offers_text: Optional[str] = None
+        self._last_offers_lock = asyncio.Lock()
+        # Готовые карточки /offer <id>: записи неизменны после сохранения,
+        # поэтому инвалидация не нужна — только LRU-вытеснение.
+        self._offer_text_cache: "OrderedDict[int, str]" = OrderedDict()
+        # Диспетчеризация режимов ответа модели без if/elif-цепочки.
+        self._mode_dispatch = {
+            "offer": self._dispatch_offer,
+            "search": self._dispatch_search,
+        }
+
+    async def load_commit_hash(self) -> str:
+        if self._commit_hash is None:
+            async with self._commit_lock:
+                if self._commit_hash is None:
+                    self._commit_hash = await _git_commit_hash()
+        return self._commit_hash
 
     async def handle_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        await update.message.reply_text(
-            "👋 Привет! Я CRM-бот агрегатора.\n\n"
-            "Я умею:\n"
-            "1) Принимать офферы (каналы/мерчи) и сохранять их в базу.\n"
-            "2) Искать по базе простыми фразами.\n\n"
-            "Примеры:\n"
-            "- RU SBP вход 1.8% курс 98 лимиты 10k–300k\n"
-            "- дай все офферы по индии\n"
-            "- дай офферы по сбп рф дешевле 11%\n\n"
-            "Последние офферы: /offers\n"
-            "Оффер по ID: /offer 10"
-        )
+        _send_in_background(update.message.reply_text(_START_TEXT))
 
     async def handle_text(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         user_text = update.message.text or ""
-        chat_id = update.effective_chat.id
 
-        await update.message.reply_text("⏳ Думаю над запросом...")
+        cache_key = _interpret_cache_key(user_text)
+        data = self._interpret_cache.get(cache_key)
+
+        ack_task = None
+        if data is not None:
+            # Кешированный ответ приходит за миллисекунды — «⏳» только мелькал бы.
+            self._interpret_cache.move_to_end(cache_key)
+        else:
+            # Ack и запрос к модели — независимые сетевые вызовы, пускаем их параллельно.
+            ack_task = asyncio.create_task(update.message.reply_text("⏳ Думаю над запросом..."))
 
         try:
-            data = await self.interpreter.interpret(user_text)
-            mode = data.get("mode")
-
-            if mode == "offer":
-                await self._handle_offer_mode(data, user_text, chat_id, context)
-            elif mode == "search":
-                await self._handle_search_mode(data, update)
-            else:
-                await update.message.reply_text(
-                    "Я не понял, это оффер или поиск 🤔\n"
-                    "Попробуй переформулировать или начни с чего-то вроде:\n"
-                    "— 'дай офферы по ...'\n"
-                    "— или просто пришли оффер."
-                )
+            if data is None:
+                data = await self.interpreter.interpret(user_text)
+                self._interpret_cache[cache_key] = data
+                if len(self._interpret_cache) > _INTERPRET_CACHE_MAX:
+                    self._interpret_cache.popitem(last=False)
+                await ack_task
+
+            handler = self._mode_dispatch.get(data.get("mode"), self._dispatch_unknown)
+            await handler(data, user_text, update, context)
         except Exception as exc:  # noqa: BLE001
             logger.exception("Ошибка в обработке текста")
+            if ack_task is not None:
+                await asyncio.gather(ack_task, return_exceptions=True)
             await update.message.reply_text(
                 "❌ Ошибка при обработке:\n"
                 f"{exc}"
             )
 
     async def handle_offers(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        rows = await self.offers.list_last_offers(limit=10)
-        if not rows:
+        text = self._last_offers_text
+        if text is None:
+            async with self._last_offers_lock:
+                text = self._last_offers_text
+                if text is None:
+                    rendered = await self.offers.list_last_offers_rendered(limit=10)
+                    if rendered:
+                        text = _LAST_OFFERS_HEADER + "\n".join(rendered)
+                        self._last_offers_text = text
+
+        if text is None:
             await update.message.reply_text("Пока офферов нет. Отправь первый текст оффера.")
             return
 
-        lines: List[str] = ["📋 *Последние офферы:*", ""]
-        for row in rows:
-            oid, country, method, fee, rate, status, created_at, kind, fee_percent = row
-            kind_str = kind or "—"
-            fee_str = fee or (f"{fee_percent}%" if fee_percent is not None else "—")
-            lines.append(
-                f"ID *{oid}* — [{kind_str}] {country or '—'} / {method or '—'} / "
-                f"{fee_str} / {rate or 'курс ?'} — _{status}_"
-            )
-        await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
+        await update.message.reply_text(text, parse_mode="Markdown")
 
     async def handle_offer(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         if not context.args:
             await update.message.reply_text("Использование: /offer <id>")
             return
 
-        try:
-            offer_id = int(context.args[0])
-        except ValueError:
+        arg = context.args[0]
+        # Предпроверка вместо try/except: ветка дешевле создания исключения,
+        # а мусор длиннее 10 цифр отсекается ещё до int().
+        if not arg.isdecimal() or len(arg) > 10:
             await update.message.reply_text("ID должен быть числом, пример: /offer 12")
             return
+        offer_id = int(arg)
+
+        cached_text = self._offer_text_cache.get(offer_id)
+        if cached_text is not None:
+            self._offer_text_cache.move_to_end(offer_id)
+            await update.message.reply_text(cached_text, parse_mode="Markdown")
+            return
 
         row = await self.offers.get_offer_by_id(offer_id)
         if not row:
@@ -118,20 +232,18 @@ class BotService:
             fee_percent,
         ) = row
 
-        kind_str = kind or "—"
-        fee_str = fee or (f"{fee_percent}%" if fee_percent is not None else "—")
-
+        # country/method/fee/rate/kind приходят из *_display-колонок готовыми.
         lines = [
             f"📄 *Оффер ID {oid}*",
-            f"Тип: _{kind_str}_",
+            f"Тип: _{kind}_",
             f"Статус: _{status}_",
             "",
-            f"*Страна:* {country or '—'}",
-            f"*Метод:* {method or '—'}",
-            f"*Комиссия:* {fee_str}",
-            f"*Курс:* {rate or '—'}",
-            f"*Лимиты:* {limits or '—'}",
-            f"*Условия:* {conditions or '—'}",
+            f"*Страна:* {country}",
+            f"*Метод:* {method}",
+            f"*Комиссия:* {fee}",
+            f"*Курс:* {rate}",
+            f"*Лимиты:* {limits or _DASH}",
+            f"*Условия:* {conditions or _DASH}",
             "",
             f"*Создан:* {created_at}",
             f"*Обновлён:* {updated_at}",
@@ -140,32 +252,49 @@ class BotService:
             raw_text,
         ]
 
-        await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
+        text = "\n".join(lines)
+        self._offer_text_cache[offer_id] = text
+        if len(self._offer_text_cache) > _OFFER_CACHE_MAX:
+            self._offer_text_cache.popitem(last=False)
+
+        await update.message.reply_text(text, parse_mode="Markdown")
 
     async def handle_version(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        lines = [
-            "ℹ️ *Версия бота*",
-            f"Commit: `{self.commit_hash}`",
-            f"Запущен: {self.started_at}",
-        ]
-        await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
+        if self._version_text is None:
+            commit_hash = await self.load_commit_hash()
+            self._version_text = _VERSION_TEMPLATE.format(commit=commit_hash, started=self.started_at)
+        _send_in_background(update.message.reply_text(self._version_text, parse_mode="Markdown"))
+
+    async def _dispatch_offer(
+        self, data: Dict[str, Any], user_text: str, update: Update, context: ContextTypes.DEFAULT_TYPE
+    ) -> None:
+        await self._handle_offer_mode(data, user_text, update.effective_chat.id, context)
+
+    async def _dispatch_search(
+        self, data: Dict[str, Any], user_text: str, update: Update, context: ContextTypes.DEFAULT_TYPE
+    ) -> None:
+        await self._handle_search_mode(data, update)
+
+    async def _dispatch_unknown(
+        self, data: Dict[str, Any], user_text: str, update: Update, context: ContextTypes.DEFAULT_TYPE
+    ) -> None:
+        await update.message.reply_text(_UNKNOWN_MODE_TEXT)
 
     async def _handle_offer_mode(
         self, data: Dict[str, Any], user_text: str, chat_id: int, context: ContextTypes.DEFAULT_TYPE
     ) -> None:
         parsed = data.get("offer") or {}
-        offer_id = await self.offers.save_offer(parsed, user_text)
+        save_task = asyncio.create_task(self.offers.save_offer(parsed, user_text))
 
+        # Телу ответа нужен только parsed — рендерим, пока идёт INSERT.
         lines: List[str] = [
-            f"✅ Оффер сохранён. ID: *{offer_id}*",
-            "",
-            f"*Тип:* {parsed.get('kind') or '—'}",
-            f"*Страна:* {parsed.get('country') or '—'}",
-            f"*Метод:* {parsed.get('method') or '—'}",
-            f"*Комиссия:* {parsed.get('fee') or '—'}",
-            f"*Курс:* {parsed.get('rate') or '—'}",
-            f"*Лимиты:* {parsed.get('limits') or '—'}",
-            f"*Условия:* {parsed.get('conditions') or '—'}",
+            f"*Тип:* {parsed.get('kind') or _DASH}",
+            f"*Страна:* {parsed.get('country') or _DASH}",
+            f"*Метод:* {parsed.get('method') or _DASH}",
+            f"*Комиссия:* {parsed.get('fee') or _DASH}",
+            f"*Курс:* {parsed.get('rate') or _DASH}",
+            f"*Лимиты:* {parsed.get('limits') or _DASH}",
+            f"*Условия:* {parsed.get('conditions') or _DASH}",
         ]
 
         fee_percent = parsed.get("fee_percent")
@@ -176,24 +305,33 @@ class BotService:
         if short_summary:
             lines.extend(["", f"_Краткое резюме:_ {short_summary}"])
 
-        await context.bot.send_message(chat_id=chat_id, text="\n".join(lines), parse_mode="Markdown")
+        body = "\n".join(lines)
+
+        offer_id = await save_task
+        # Записи редки по сравнению с поиском — проще сбросить кеши целиком.
+        self._search_cache.clear()
+        self._last_offers_text = None
+
+        text = f"✅ Оффер сохранён. ID: *{offer_id}*\n\n{body}"
+        await context.bot.send_message(chat_id=chat_id, text=text, parse_mode="Markdown")
 
     async def _handle_search_mode(self, data: Dict[str, Any], update: Update) -> None:
         filters = data.get("search") or {}
-        rows = await self.offers.search_offers(filters, limit=20)
 
-        if not rows:
+        cache_key = _search_cache_key(filters)
+        now = time.monotonic()
+        entry = self._search_cache.get(cache_key)
+        if entry is not None and now - entry[0] < _SEARCH_CACHE_TTL:
+            self._search_cache.move_to_end(cache_key)
+            rendered = entry[1]
+        else:
+            rendered = await self.offers.search_offers_rendered(filters, limit=20)
+            self._search_cache[cache_key] = (now, rendered)
+            if len(self._search_cache) > _SEARCH_CACHE_MAX:
+                self._search_cache.popitem(last=False)
+
+        if not rendered:
             await update.message.reply_text("Ничего не нашёл по этому запросу 🤷‍♂️")
             return
 
-        lines: List[str] = ["📋 *Результаты поиска:*", ""]
-        for row in rows:
-            oid, country, method, fee, rate, status, kind, fee_percent = row
-            kind_str = kind or "—"
-            fee_str = fee or (f"{fee_percent}%" if fee_percent is not None else "—")
-            lines.append(
-                f"ID *{oid}* — [{kind_str}] {country or '—'} / {method or '—'} / "
-                f"{fee_str} / {rate or 'курс ?'} — _{status}_"
-            )
-
-        await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
+        await update.message.reply_text(_SEARCH_HEADER + "\n".join(rendered), parse_mode="Markdown")